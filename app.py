@@ -1,6 +1,17 @@
 from flask import Flask, request, jsonify
-import requests
+from werkzeug.exceptions import HTTPException
+import asyncio
+import hashlib
+import math
+import httpx
+import orjson
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from tenacity import retry, retry_if_result, stop_after_attempt, wait_exponential_jitter
 from dotenv import load_dotenv
 import logging
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, REGISTRY
@@ -24,77 +35,179 @@ response_time = Histogram('goodiebox_api_response_time_seconds', 'API response t
 grok_calls = Counter('goodiebox_grok_api_calls_total', 'Total Grok 3 API calls')
 cac_distribution = Gauge('goodiebox_predicted_cac', 'Predicted CAC')
 status_codes = Counter('goodiebox_api_status_codes_total', 'HTTP status codes returned', ['status_code'])
+cache_hits = Counter('goodiebox_prediction_cache_hits_total', 'Predictions served from the cache')
 
 # Grok 3 API configuration
 XAI_API_KEY = os.getenv('XAI_API_KEY')
 GROK_API_URL = 'https://api.x.ai/v1/chat/completions'  # Update with actual endpoint
+GROK_HEADERS = {
+    'Authorization': f'Bearer {XAI_API_KEY}',
+    'Content-Type': 'application/json'
+}
+GROK_HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+GROK_TIMEOUT = 30.0
+GROK_CONNECT_RETRIES = 3
+GROK_MAX_IN_FLIGHT = 20  # Concurrent Grok calls per worker; tune to the account's rate limit
+GROK_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+GROK_RETRY_MAX_WAIT = 30.0  # Upper bound in seconds on any single retry wait, including Retry-After
+GROK_SAMPLES = 1  # Completions averaged per prediction; greedy decoding makes extra samples identical
+# The whole model output must be one number, optionally wrapped in currency symbols and
+# punctuation, e.g. '€10.50.' -> '10.50'; '10,50' or '8-10' are rejected rather than truncated
+NUMBER_RE = re.compile(r'[\s€$£]*(-?(?:\d+(?:\.\d+)?|\.\d+)(?:[eE][-+]?\d+)?)[\s€$£.!;:]*')
+MAX_INPUT_CHARS = 100_000  # Combined prompt input size accepted by /predict_box_score
+GROK_SYSTEM_MESSAGE = {
+    'role': 'system',
+    'content': 'You are an expert in predicting Goodiebox performance, skilled at analyzing historical trends.'
+}
+
+# Long-lived event loop so the shared client's keep-alive pool survives across requests
+grok_loop = asyncio.new_event_loop()
+threading.Thread(target=grok_loop.run_forever, name='grok-loop', daemon=True).start()
+
+# Shared client; its connections are only ever used from grok_loop
+grok_client = httpx.AsyncClient(
+    timeout=GROK_TIMEOUT,
+    headers=GROK_HEADERS,
+    transport=httpx.AsyncHTTPTransport(limits=GROK_HTTP_LIMITS, retries=GROK_CONNECT_RETRIES)
+)
+
+grok_semaphore = asyncio.Semaphore(GROK_MAX_IN_FLIGHT)
+
+def _retry_after_seconds(response):
+    """Parse a Retry-After header given as seconds or an HTTP date; None if absent or invalid."""
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+_grok_backoff = wait_exponential_jitter(initial=1, max=GROK_RETRY_MAX_WAIT)
+
+def _grok_retry_wait(retry_state):
+    """Honour Retry-After on throttled responses, falling back to jittered exponential backoff."""
+    retry_after = _retry_after_seconds(retry_state.outcome.result())
+    if retry_after is None:
+        return _grok_backoff(retry_state)
+    return min(retry_after, GROK_RETRY_MAX_WAIT)
+
+def _log_grok_retry(retry_state):
+    response = retry_state.outcome.result()
+    logger.warning(f"xAI API returned {response.status_code}, retrying in {retry_state.next_action.sleep:.1f}s")
+
+@retry(
+    retry=retry_if_result(lambda response: response.status_code in GROK_RETRY_STATUS_CODES),
+    wait=_grok_retry_wait,
+    stop=stop_after_attempt(5),
+    before_sleep=_log_grok_retry,
+    retry_error_callback=lambda retry_state: retry_state.outcome.result()
+)
+async def _fetch_grok_response(body):
+    """Send a pre-encoded JSON request body to the Grok 3 API on the shared client and return the response.
+
+    Retries rate-limited and 5xx responses, waiting as long as Retry-After asks when present;
+    the last response is returned if they persist.
+    """
+    async with grok_semaphore:
+        grok_calls.inc()
+        return await grok_client.post(GROK_API_URL, content=body)
+
+# Grok runs with temperature 0 and a fixed seed, so identical prompts give identical predictions
+PREDICTION_CACHE_SIZE = 2048
+prediction_cache = OrderedDict()
+prediction_cache_lock = threading.Lock()
+
+def _prediction_cache_key(name, prompt, n):
+    """Hash a prediction name, prompt and sample count into a compact cache key."""
+    return hashlib.blake2b(f"{name}:{n}:{prompt}".encode(), digest_size=16).hexdigest()
+
+def _get_cached_prediction(key):
+    with prediction_cache_lock:
+        value = prediction_cache.get(key)
+        if value is not None:
+            prediction_cache.move_to_end(key)
+        return value
+
+def _set_cached_prediction(key, value):
+    with prediction_cache_lock:
+        prediction_cache[key] = value
+        prediction_cache.move_to_end(key)
+        if len(prediction_cache) > PREDICTION_CACHE_SIZE:
+            prediction_cache.popitem(last=False)
+
+def predict(name, prompt, n, validate):
+    """Average n Grok 3 completions of a prompt into a two-decimal string, rejecting values that fail validate.
+
+    name labels the predicted quantity (e.g. 'CAC') in errors and keys the cache, so callers
+    with different validators never share cached results.
+    """
+    cache_key = _prediction_cache_key(name, prompt, n)
+    cached = _get_cached_prediction(cache_key)
+    if cached is not None:
+        cache_hits.inc()
+        logger.info(f"Returning cached {name}: {cached}")
+        return cached
+    payload = {
+        'model': 'grok-3',
+        'messages': [
+            GROK_SYSTEM_MESSAGE,
+            {
+                'role': 'user',
+                'content': prompt
+            }
+        ],
+        'max_tokens': 10,
+        'temperature': 0,
+        'seed': 42,
+        'n': n
+    }
+    body = orjson.dumps(payload)
+    logger.info(f"Sending request to xAI API: {payload}")
+    response = asyncio.run_coroutine_threadsafe(_fetch_grok_response(body), grok_loop).result()
+    status_codes.labels(status_code=str(response.status_code)).inc()
+    if response.status_code != 200:
+        logger.error(f"xAI API error: {response.status_code} - {response.text}")
+        raise Exception(f"xAI API error: {response.status_code} - {response.text}")
+    result = orjson.loads(response.content)
+    values = []
+    for choice in result.get('choices', []):
+        content = choice.get('message', {}).get('content', '').strip()
+        logger.info(f"Run response: {content}")
+        if not content:
+            logger.error("Model returned an empty response")
+            raise ValueError("Empty response from model")
+        match = NUMBER_RE.fullmatch(content)
+        value = float(match.group(1)) if match else None
+        if value is None or not math.isfinite(value) or not validate(value):
+            logger.error(f"Invalid {name} format: {content}")
+            raise ValueError(f"Invalid {name}: {content}")
+        values.append(value)
+    if not values:
+        raise ValueError(f"No valid {name} values collected")
+    final = f"{sum(values) / len(values):.2f}"
+    logger.info(f"Averaged {name} from {len(values)} runs: {final}")
+    _set_cached_prediction(cache_key, final)
+    return final
 
 def predict_box_cac(historical_data, future_box_info):
     """Predict the Customer Acquisition Cost (CAC) in euros for a future welcome box using Grok 3 API."""
     with response_time.labels(endpoint='/predict_box_score').time():
-        try:
-            prompt = f"""
+        prompt = f"""
 You are an expert in evaluating Goodiebox welcome boxes for their ability to attract new members at low Customer Acquisition Cost (CAC). Based on the historical data provided, which includes box features and their corresponding CAC in euros, predict the CAC for the future welcome box. The CAC should be a numerical value in euros, with two decimal places (e.g., 10.50). Consider factors such as the number of products, total retail value, number of unique categories, number of full-size products, number of premium products (>€20), total weight, average product rating, average brand rating, average category rating, and niche products. Return only the numerical CAC value in euros (e.g., 10.50).
 
 Historical Data: {historical_data}
 
 Future Box Info: {future_box_info}
 """
-            headers = {
-                'Authorization': f'Bearer {XAI_API_KEY}',
-                'Content-Type': 'application/json'
-            }
-            cacs = []
-            for _ in range(10):  # Increased to 10 iterations
-                payload = {
-                    'model': 'grok-3',
-                    'messages': [
-                        {
-                            'role': 'system',
-                            'content': 'You are an expert in predicting Goodiebox performance, skilled at analyzing historical trends.'
-                        },
-                        {
-                            'role': 'user',
-                            'content': prompt
-                        }
-                    ],
-                    'max_tokens': 10,
-                    'temperature': 0,
-                    'seed': 42
-                }
-                logger.info(f"Sending request to xAI API: {payload}")
-                grok_calls.inc()
-                response = requests.post(GROK_API_URL, json=payload, headers=headers)
-                status_codes.labels(status_code=str(response.status_code)).inc()
-                if response.status_code != 200:
-                    logger.error(f"xAI API error: {response.status_code} - {response.text}")
-                    raise Exception(f"xAI API error: {response.status_code} - {response.text}")
-                result = response.json()
-                cac = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-                logger.info(f"Run response: {cac}")
-                if not cac:
-                    logger.error("Model returned an empty response")
-                    raise ValueError("Empty response from model")
-                try:
-                    cac_float = float(cac)
-                    if cac_float < 0:
-                        raise ValueError("CAC cannot be negative")
-                    cacs.append(cac_float)
-                except ValueError as e:
-                    logger.error(f"Invalid CAC format: {cac}, error: {str(e)}")
-                    raise ValueError(f"Invalid CAC: {cac}")
-            if not cacs:
-                raise ValueError("No valid CAC values collected")
-            avg_cac = sum(cacs) / len(cacs)
-            final_cac = f"{avg_cac:.2f}"
-            cac_distribution.set(float(final_cac))
-            logger.info(f"Averaged CAC from 10 runs: {final_cac}")
-            success_count.labels(endpoint='/predict_box_score').inc()
-            return final_cac
-        except Exception as e:
-            error_count.labels(endpoint='/predict_box_score').inc()
-            logger.error(f"Error in prediction: {str(e)}")
-            raise Exception(f"Prediction error: {str(e)}")
+        final_cac = predict('CAC', prompt, GROK_SAMPLES, lambda cac: cac >= 0)
+        cac_distribution.set(float(final_cac))
+        success_count.labels(endpoint='/predict_box_score').inc()
+        return final_cac
 
 @app.route('/predict_box_score', methods=['POST'])
 def box_score():
@@ -102,20 +215,31 @@ def box_score():
     request_count.labels(endpoint='/predict_box_score').inc()
     try:
         data = request.get_json()
-        if not data or 'future_box_info' not in data:
+        if not isinstance(data, dict) or not data.get('future_box_info'):
             logger.error("Missing future box info")
             error_count.labels(endpoint='/predict_box_score').inc()
             status_codes.labels(status_code='400').inc()
             return jsonify({'error': 'Missing future_box_info'}), 400
         historical_data = data.get('historical_data', 'No historical data provided')
         future_box_info = data['future_box_info']
+        if len(str(historical_data)) + len(str(future_box_info)) > MAX_INPUT_CHARS:
+            logger.error("Prediction input too large")
+            error_count.labels(endpoint='/predict_box_score').inc()
+            status_codes.labels(status_code='400').inc()
+            return jsonify({'error': f'historical_data and future_box_info exceed {MAX_INPUT_CHARS} characters'}), 400
         cac = predict_box_cac(historical_data, future_box_info)
         status_codes.labels(status_code='200').inc()
         return jsonify({'predicted_cac': cac})
+    except HTTPException as e:
+        logger.error(f"Invalid request: {str(e)}")
+        error_count.labels(endpoint='/predict_box_score').inc()
+        status_codes.labels(status_code=str(e.code)).inc()
+        return jsonify({'error': str(e)}), e.code
     except Exception as e:
+        logger.error(f"Error in prediction: {str(e)}")
         error_count.labels(endpoint='/predict_box_score').inc()
         status_codes.labels(status_code='500').inc()
-        return jsonify({'error': str(e)}), 500
+        return jsonify({'error': f"Prediction error: {str(e)}"}), 500
 
 @app.route('/metrics', methods=['GET'])
 def metrics():
@@ -0,0 +1,18 @@
+import os
+from dotenv import load_dotenv
+
+# Threaded workers: each request blocks on the Grok API, and gevent's monkey-patching
+# does not mix with the asyncio loop thread app.py runs its Grok client on
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+timeout = 60
+
+# Keep preload_app off: app.py starts its Grok event loop thread at import time,
+# and threads do not survive the fork into workers
+
+def on_starting(server):
+    load_dotenv()
+    if not os.getenv('XAI_API_KEY'):
+        raise ValueError("XAI_API_KEY not set")